@@ -4,80 +4,213 @@
 # License: XXX
 
 import argparse
-import cProfile
-import copy
+import csv
+import functools
 import os
 import os.path as pth
 import time
 import traceback
 
+# The numba kernels (kjl.model.kernels) are compiled with cache=True. Store the cache under the output directory,
+# so the kernels are only compiled once and then reloaded by the later runs of this script.
+# Note that NUMBA_CACHE_DIR must be set before numba is imported.
+os.environ.setdefault('NUMBA_CACHE_DIR', pth.join('speedup', 'out', '.numba_cache'))
+
 import numpy as np
-import pandas as pd
-from sklearn import metrics
-from sklearn.metrics import roc_curve
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.stats import rankdata
 
-from kjl import pstats
 from kjl.log import get_log
 from kjl.model.gmm import GMM
+from kjl.model.kernels import kjl_ocsvm_score, kjl_gmm_full_score, kjl_gmm_diag_score
 from kjl.model.kjl import KJL
 from kjl.model.nystrom import NYSTROM
 from kjl.model.ocsvm import OCSVM
-from kjl.utils.tool import load_data, dump_data
+from kjl.utils.tool import load_data, dump_data, load_npy, dump_npy
 
 # create a customized log instance that can print the information.
 lg = get_log(level='info')
 
 
-def _test(model, X_test, y_test, params, project):
-    """Evaluate the model on the X_test, y_test
+def _project(project, X_test, params):
+    """Project X_test onto a lower space if the model uses KJL or Nystrom.
+
+    Parameters
+    ----------
+    project: a recreated project object
+    X_test: numpy array (n, D)
+    params: a dict stored parameters and used in testing.
+
+    Returns
+    -------
+       X_test: the projected X_test (or the original one if no projection is used)
+       Projection time
+    """
+    start = time.perf_counter()
+    if 'is_kjl' in params.keys() and params['is_kjl']:
+        X_test = project.transform(X_test)
+    elif 'is_nystrom' in params.keys() and params['is_nystrom']:
+        X_test = project.transform(X_test)
+    else:
+        pass
+    proj_test_time = time.perf_counter() - start
+
+    return X_test, proj_test_time
+
+
+def _can_fuse(model, params):
+    """Check if the projection and the model can be tested together by a fused (numba) kernel.
 
     Parameters
     ----------
     model: a recreated model object
+    params: a dict stored parameters and used in testing.
+
+    Returns
+    -------
+        boolean
+    """
+    if not (params['is_kjl'] or params['is_nystrom']):
+        return False
+    if isinstance(model, OCSVM):
+        return model.kernel == 'rbf'
+    elif isinstance(model, GMM):
+        return model.covariance_type in ['full', 'diag']
+    else:
+        return False
+
+
+def _fused_decision_function(model, X_test, project, params):
+    """Project X_test and get its abnormal scores in one pass, i.e., the projected X_test is never stored in memory.
+     It's the same as "model.decision_function(project.transform(X_test))".
+
+    Parameters
+    ----------
+    model: a recreated model object (OCSVM(rbf), GMM(full) or GMM(diag))
     X_test: numpy array (n, D)
-        n is the number of datapoints and D is the dimensions
+    project: a recreated project object (KJL or Nystrom)
+    params: a dict stored parameters and used in testing.
+
+    Returns
+    -------
+        y_score: abnormal scores
+    """
+    P = project.U if params['is_kjl'] else project.eigvec_lambda
+    if isinstance(model, OCSVM):
+        y_score = kjl_ocsvm_score(X_test, project.Xrow, project.sigma, P, model.support_vectors_,
+                                  model.dual_coef_.ravel(), model.gamma, model.intercept_[0])
+    elif model.covariance_type == 'full':
+        y_score = kjl_gmm_full_score(X_test, project.Xrow, project.sigma, P, model.weights_, model.means_,
+                                     model.precisions_cholesky_)
+    else:
+        y_score = kjl_gmm_diag_score(X_test, project.Xrow, project.sigma, P, model.weights_, model.means_,
+                                     model.precisions_cholesky_)
+
+    # both OCSVM.decision_function() and GMM.decision_function() return "-1 * score"
+    return -1 * y_score
+
+
+def _fast_rbf_decision(model, X_test, X_sqnorm):
+    """Get the abnormal scores of an OCSVM (rbf) model, i.e., "model.decision_function(X_test)".
+    With ||x - sv||^2 = ||x||^2 + ||sv||^2 - 2 x.sv, the kernel matrix only needs one matrix product (BLAS GEMM),
+    and ||sv||^2 (model.sv_sqnorm_, see build_model()) and ||x||^2 (X_sqnorm) are precomputed.
+    The kernel matrix is computed in the dtype of X_test and model.support_vectors_, i.e., float64 or float32 (only
+    with is_float32, see build_model()).
+
+    Parameters
+    ----------
+    model: a recreated OCSVM (rbf) model
+    X_test: numpy array (n, D)
+    X_sqnorm: numpy array (n, )
+        ||x||^2 of each datapoint in X_test
+
+    Returns
+    -------
+        y_score: abnormal scores
+    """
+    K = np.matmul(X_test, model.support_vectors_.transpose())  # nxm
+    K *= -2
+    K += X_sqnorm[:, np.newaxis]
+    K += model.sv_sqnorm_[np.newaxis, :]
+    np.maximum(K, 0, out=K)  # avoid tiny negative distances caused by the rounding errors
+    K *= -model.gamma
+    # exp(-700) ~ 1e-304 (exp(-87) ~ 1.6e-38 in float32) is already negligible, and exp() is much slower when its
+    # result underflows to a subnormal
+    np.maximum(K, -700 if K.dtype == np.float64 else -87, out=K)
+    np.exp(K, out=K)
+    pred_v = np.matmul(K, model.dual_coef_.ravel()) + model.intercept_
+
+    return -1 * pred_v
+
+
+def _roc_auc(y_test, y_score):
+    """Get the AUC by the Mann-Whitney U statistic, i.e., the probability that a random abnormal datapoint (y=1)
+    gets a higher score than a random normal one. It equals "metrics.auc(*roc_curve(y_test, y_score)[:2])", but
+    only needs one sort of y_score.
+
+    Parameters
+    ----------
     y_test: numpy array (n, )
+        NORMAL(inliers): 0, ABNORMAL(outliers: positive): 1
+    y_score: numpy array (n, )
+        abnormal scores
+
+    Returns
+    -------
+        AUC
+    """
+    pos = (y_test == 1)
+    n_pos = np.sum(pos)
+    n_neg = len(y_test) - n_pos
+    # tied scores get the average of their ranks, which is the same as the trapezoidal rule used by metrics.auc()
+    ranks = rankdata(y_score)
+    auc = (np.sum(ranks[pos]) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+    return auc
+
+
+def _predict_and_time(model, X_test, params, project):
+    """Get the abnormal scores of X_test and the time used to get them
+
+    Parameters
+    ----------
+    model: a recreated model object
+    X_test: numpy array (n, D)
+        n is the number of datapoints and D is the dimensions
     params: a dict stored parameters and used in testing.
 
     project: a recreated project object
 
     Returns
     -------
-       AUC:
+       y_score: abnormal scores
        Test time
     """
+    # _predict_and_time must not mutate params (it's shared by all the repeats in evaluate_model())
 
     test_time = 0
 
     #####################################################################################################
     # 1. standardization
-    # pr = cProfile.Profile(time.perf_counter)
-    # pr.enable()
-    # # if self.params['is_std']:
-    # #     X_test = self.scaler.transform(X_test)
-    # # else:
-    # #     pass
-    # pr.disable()
-    # ps = pstats.Stats(pr).sort_stats('line')  # cumulative
-    # # ps.print_stats()
-    # proj_test_time = ps.total_tt
+    # start = time.perf_counter()
+    # if self.params['is_std']:
+    #     X_test = self.scaler.transform(X_test)
+    # else:
+    #     pass
+    # std_test_time = time.perf_counter() - start
     std_test_time = 0
     test_time += std_test_time
 
     #####################################################################################################
     # 2. projection
-    pr = cProfile.Profile(time.perf_counter)
-    pr.enable()
-    if 'is_kjl' in params.keys() and params['is_kjl']:
-        X_test = project.transform(X_test)
-    elif 'is_nystrom' in params.keys() and params['is_nystrom']:
-        X_test = project.transform(X_test)
+    if params.get('is_fused', False):
+        # X_test will be projected together with the prediction, so the projection time is in model_test_time.
+        proj_test_time = 0
+    elif params.get('_skip_project', False):
+        # X_test has already been projected (once) in evaluate_model(), so reuse its projection time.
+        proj_test_time = params['_proj_test_time']
     else:
-        pass
-    pr.disable()
-    ps = pstats.Stats(pr).sort_stats('line')  # cumulative
-    # ps.print_stats()
-    proj_test_time = ps.total_tt
+        X_test, proj_test_time = _project(project, X_test, params)
     test_time += proj_test_time
 
     # no need to do seek in the testing phase
@@ -85,48 +218,43 @@ def _test(model, X_test, y_test, params, project):
 
     #####################################################################################################
     # 3. prediction
-    pr = cProfile.Profile(time.perf_counter)
-    pr.enable()
+    start = time.perf_counter()
     # For inlier, a small value is used; a larger value is for outlier (positive)
     # it must be abnormal score because we use y=1 as abnormal and roc_acu(pos_label=1)
-    y_score = model.decision_function(X_test)
-    pr.disable()
-    ps = pstats.Stats(pr).sort_stats('line')  # cumulative
-    # ps.print_stats()
-    model_test_time = ps.total_tt
+    if params.get('is_fused', False):
+        y_score = _fused_decision_function(model, X_test, project, params)
+    elif isinstance(model, OCSVM) and model.kernel == 'rbf':
+        y_score = _fast_rbf_decision(model, X_test, params['_X_sqnorm'])
+    else:
+        y_score = model.decision_function(X_test)
+    model_test_time = time.perf_counter() - start
     test_time += model_test_time
 
-    # For binary  y_true, y_score is supposed to be the score of the class with greater label.
-    # auc = roc_auc_score(y_test, y_score)  # NORMAL(inliers): 0, ABNORMAL(outliers: positive): 1
-    # pos_label = 1, so y_score should be the corresponding score (i.e., abnormal score)
-    fpr, tpr, _ = roc_curve(y_test, y_score, pos_label=1)
-    auc = metrics.auc(fpr, tpr)
-
     lg.info(f'Total test time: {test_time} <= std_test_time: {std_test_time}, '
              f'seek_test_time: {seek_test_time}, proj_test_time: {proj_test_time}, '
              f'model_test_time: {model_test_time}')
 
-    return auc, test_time
+    return y_score, test_time
 
 
-def evaluate_model(model_params, project_params, X_test, y_test, nums=20, is_average=True):
-    """ Recreate new model and project objects based on the parameters and evaluate on test set.
+def build_model(model_params, project_params, is_float32=False, is_fused=False):
+    """ Recreate new model and project objects based on the parameters.
 
     Parameters
     ----------
     model_params: a dict stored only model parameters
     project_params: a dict stored projection parameters
-    X_test
-    y_test
-    nums: the number of testing times used for getting stable testing time.
-        default is 20.
-    is_average: boolean (default True)
-        If True (dafault), get the average testing time.
+    is_float32: boolean (default False)
+        If True, project X_test and compute the OCSVM (rbf) kernel matrix in float32 instead of float64.
+    is_fused: boolean (default False)
+        If True and possible, project X_test and compute the scores in one fused kernel (see
+        _fused_decision_function()).
 
     Returns
     -------
-        AUC
-        Test time
+        model: a recreated model object
+        project: a recreated project object (None if no projection is used)
+        params: a dict stored parameters and used in testing.
     """
     model_name = model_params['model_name']
 
@@ -147,6 +275,17 @@ def evaluate_model(model_params, project_params, X_test, y_test, nums=20, is_ave
         params['is_nystrom'] = True
     else:
         project = None
+    if project is not None and is_float32:
+        # project X_test in float32 (SGEMM in transform() or the float32 version of the fused kernels), which doubles
+        # the SIMD lanes and halves the memory traffic of the kernel matrix K(X_test, Xrow), and the projection is
+        # ~1.3x faster. However, it's not the default: the rounding errors change the AUC of KJL/Nystrom-GMM(full) by
+        # up to 0.006 on the test sets (e.g., DWSHR_WSHR_2020).
+        project.Xrow = project.Xrow.astype(np.float32, copy=False)
+        if params['is_kjl']:
+            project.U = project.U.astype(np.float32, copy=False)
+        else:
+            project.eigvec_lambda = project.eigvec_lambda.astype(np.float32, copy=False)
+        project.sigma = np.float32(project.sigma)
 
     #######################################################################################################
     # 2. recreate a new model from saved parameters
@@ -168,22 +307,113 @@ def evaluate_model(model_params, project_params, X_test, y_test, nums=20, is_ave
         raise NotImplementedError()
 
     #######################################################################################################
-    # 3. Evaluate the model
+    # 3. choose how to test the model
+    # The fused kernels are faster, but they're not the default: they compute ||x - y||^2 directly (instead of the
+    # expanded form in getGaussianGram()) with fastmath, so the scores differ in the last bits and the near-tied
+    # scores are ranked differently, which changes the AUC by up to ~2e-4.
+    params['is_fused'] = is_fused and _can_fuse(model, params)
+    if not params['is_fused'] and isinstance(model, OCSVM) and model.kernel == 'rbf':
+        # ||SV||^2 is the same for all the predictions, so only compute it once (see _fast_rbf_decision()).
+        model.sv_sqnorm_ = np.einsum('ij,ij->i', model.support_vectors_, model.support_vectors_)
+        if is_float32:
+            # SGEMM doubles the SIMD lanes and halves the memory traffic of the kernel matrix, which is ~1.7x faster.
+            # However, it's not the default: the rounding errors of the expanded distances change the AUC by up to
+            # 0.011 on the test sets (e.g., DWSHR_WSHR_2020, many scores are close to each other).
+            # ||SV||^2 is computed in float64 and only rounded to float32 once. All the operands must be float32:
+            # mixed float32/float64 operations are much slower.
+            model.support_vectors_ = model.support_vectors_.astype(np.float32)
+            model.sv_sqnorm_ = model.sv_sqnorm_.astype(np.float32)
+            model.dual_coef_ = model.dual_coef_.astype(np.float32)
+            model.gamma = np.float32(model.gamma)
+
+    return model, project, params
+
+
+@functools.lru_cache(maxsize=32)
+def load_model(model_params_file, project_params_file, model_name, mtime=None, is_float32=False, is_fused=False,
+               is_npy=False):
+    """ Load the parameters from the files and recreate new model and project objects (see build_model()).
+    The results are cached, so the same model is only loaded and recreated once in a process
+    (e.g., when main() is called several times in a parameter sweep).
+
+    Parameters
+    ----------
+    model_params_file
+    project_params_file
+    model_name
+    mtime: the last modification time of the files.
+        It's only a part of the cache key, so the model is loaded again if the files are changed.
+    is_float32, is_fused: see build_model()
+    is_npy: see load_params()
+
+    Returns
+    -------
+        model, project, params: see build_model()
+    """
+    model_params = load_params(model_params_file, is_npy=is_npy)
+    model_params['model_name'] = model_name
+    project_params = load_params(project_params_file, is_npy=is_npy)
+
+    return build_model(model_params, project_params, is_float32=is_float32, is_fused=is_fused)
+
+
+def evaluate_model(model, project, params, X_test, y_test, nums=20, is_average=True):
+    """ Evaluate the recreated model on test set.
+
+    Parameters
+    ----------
+    model: a recreated model object
+    project: a recreated project object
+    params: a dict stored parameters and used in testing.
+    X_test
+    y_test
+    nums: the number of testing times used for getting stable testing time.
+        default is 20.
+    is_average: boolean (default True)
+        If True (dafault), get the average testing time.
+
+    Returns
+    -------
+        AUC
+        Test time
+    """
+    # _predict_and_time() only reads model, project and X_test (transform() and decision_function() don't modify
+    # their inputs), so the same objects can be shared by all the repeats instead of deep-copying them each time.
+    X_test = np.ascontiguousarray(X_test)
+    if project is not None:
+        # the same dtype as the project parameters (see build_model())
+        X_test = X_test.astype(project.Xrow.dtype, copy=False)
+    params = dict(params)  # don't change the params of a (cached) model
+    # If X_test can't be projected in a fused kernel, project.transform(X_test) gives the same result in every
+    # repeat, so only project X_test once here and let _predict_and_time() reuse the projected data and the
+    # projection time.
+    if (params['is_kjl'] or params['is_nystrom']) and not params['is_fused']:
+        X_test, params['_proj_test_time'] = _project(project, X_test, params)
+        params['_skip_project'] = True
+    if not params['is_fused'] and isinstance(model, OCSVM) and model.kernel == 'rbf':
+        # ||X_test||^2 is the same in every repeat (see _fast_rbf_decision()). Always compute it in float64 (X_test
+        # can be float32 with is_float32), the same as ||SV||^2, and then use the same dtype as the support vectors
+        # (see build_model()).
+        dtype = model.support_vectors_.dtype
+        params['_X_sqnorm'] = np.einsum('ij,ij->i', X_test, X_test, dtype=np.float64).astype(dtype, copy=False)
+        X_test = X_test.astype(dtype, copy=False)
     # average time
     if is_average:  # to get stable time measurement
-        auc = []
         test_time = []
         for i in range(nums):
             # lg.info(f'i={i}')
-            auc_, test_time_ = _test(copy.deepcopy(model), copy.deepcopy(X_test), copy.deepcopy(y_test),
-                                     params=copy.deepcopy(params), project=copy.deepcopy(project))
-            auc.append(auc_)
+            y_score, test_time_ = _predict_and_time(model, X_test, params=params, project=project)
             test_time.append(test_time_)
-        auc = np.mean(auc)
         test_time = np.mean(test_time)
     else:
-        auc, test_time = _test(copy.deepcopy(model), copy.deepcopy(X_test), copy.deepcopy(y_test),
-                               params=copy.deepcopy(params), project=copy.deepcopy(project))
+        y_score, test_time = _predict_and_time(model, X_test, params=params, project=project)
+
+    # The scores are the same in every repeat (the repeats are only used to get a stable testing time),
+    # so only compute the AUC once.
+    # For binary  y_true, y_score is supposed to be the score of the class with greater label.
+    # auc = roc_auc_score(y_test, y_score)  # NORMAL(inliers): 0, ABNORMAL(outliers: positive): 1
+    # pos_label = 1, so y_score should be the corresponding score (i.e., abnormal score)
+    auc = _roc_auc(y_test, y_score)
 
     return auc, test_time
 
@@ -241,6 +471,89 @@ def get_test_set_space(test_set_file, unit='KB'):
     return format_unit(space, unit)
 
 
+def get_npy_dir(in_file):
+    """ Get the directory of the '.npy' version of in_file (see dat2npy()). It's under the output directory (with the
+    same relative path, e.g., 'speedup/data/models/.../a.dat' -> 'speedup/out/data/models/.../a.dat.npy'), so the
+    generated files are never mixed with the saved models.
+
+    Parameters
+    ----------
+    in_file: a file saved by dump_data()
+
+    Returns
+    -------
+        npy_dir
+    """
+    return pth.join('speedup', 'out', pth.relpath(in_file, 'speedup')) + '.npy'
+
+
+def dat2npy(in_file):
+    """ Convert a pickled (legacy) file to the '.npy' format (i.e., the directory get_npy_dir(in_file), see
+    dump_npy()), so its arrays can be memory-mapped by load_params() instead of being unpickled.
+
+    Parameters
+    ----------
+    in_file: a file saved by dump_data(), i.e., a dict of parameters or the test set (X_test, y_test)
+
+    Returns
+    -------
+        out_dir
+    """
+    data = load_data(in_file)
+    if isinstance(data, tuple):  # test set
+        X_test, y_test = data
+        data = {'X_test': X_test, 'y_test': y_test}
+    out_dir = get_npy_dir(in_file)
+    dump_npy(data, out_dir)
+
+    return out_dir
+
+
+def is_npy_outdated(in_file):
+    """ Check if the '.npy' version of in_file (see dat2npy()) needs to be (re)generated, i.e., it doesn't exist or
+    it's older than in_file.
+
+    Parameters
+    ----------
+    in_file: a file saved by dump_data()
+
+    Returns
+    -------
+        boolean
+    """
+    # dump_npy() writes all the files before renaming the directory, so 'meta.dat' only exists if all of them exist
+    meta_file = pth.join(get_npy_dir(in_file), 'meta.dat')
+    if not pth.exists(meta_file):
+        return True
+
+    return pth.getmtime(in_file) > pth.getmtime(meta_file)
+
+
+def load_params(in_file, is_npy=False):
+    """ Load the parameters (or the test set) saved in in_file.
+
+    Parameters
+    ----------
+    in_file
+    is_npy: boolean (default False)
+        If True, memory-map the arrays in get_npy_dir(in_file) (see dat2npy(), it must be up to date); otherwise,
+        unpickle in_file (legacy format).
+
+    Returns
+    -------
+        a dict of parameters or the test set (X_test, y_test)
+    """
+    if not is_npy:
+        return load_data(in_file)
+
+    # copy-on-write: the arrays are still memory-mapped, but writeable as the numba kernels only accept writeable arrays
+    data = load_npy(get_npy_dir(in_file), mmap_mode='c')
+    if 'X_test' in data.keys():  # test set
+        return data['X_test'], data['y_test']
+
+    return data
+
+
 def res2csv(dataset_name, model_name, res, out_file='.csv'):
     """ data to csv
 
@@ -260,24 +573,79 @@ def res2csv(dataset_name, model_name, res, out_file='.csv'):
     X_test_shape = res['X_test_shape']
     params = res['params']
 
-    aucs = "-".join([str(v) for v in res['aucs']])
-    train_times = "-".join([str(v) for v in res['train_times']])
-    test_times = "-".join([str(v) for v in res['test_times']])
-    space_sizes = "-".join([str(v) for v in res['space_sizes']])
-    model_spaces = "-".join([str(v) for v in res['model_spaces']])
+    aucs = "-".join(map(str, res['aucs']))
+    train_times = "-".join(map(str, res['train_times']))
+    test_times = "-".join(map(str, res['test_times']))
+    space_sizes = "-".join(map(str, res['space_sizes']))
+    model_spaces = "-".join(map(str, res['model_spaces']))
     line = f' {dataset_name}|, {model_name}, X_train: {X_train_shape}|X_val: {X_val_shape}, X_test: {X_test_shape}, ' \
            f'auc:, train:, test:, => aucs:{aucs}, ' \
            f'train_times:{train_times}, test_times:{test_times}, n_comp: ,' \
            f', space_sizes: {space_sizes}|model_spaces: {model_spaces},' \
            f' tot_clusters: , ,' \
            f' n_clusters: , , with params: {params}: '
-    pd.DataFrame(line.split(',')).to_csv(out_file + '.csv', sep=',', index=False, encoding='utf-8-sig')
+    # write the same one-column csv as "pd.DataFrame(line.split(',')).to_csv(index=False)" (i.e., the header '0'
+    # and then one field per row), but without building a DataFrame.
+    with open(out_file + '.csv', 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerows([['0']] + [[v] for v in line.split(',')])
 
     return out_file
 
 
+def _one_repeat(i, in_dir, model_name, X_test, y_test, load_model_func, nums_average=3, is_npy=False, unit='KB',
+                is_float32=False, is_fused=False):
+    """ Recreate the i_th model from the saved parameters and evaluate it on the test set.
+
+    Parameters
+    ----------
+    i: the i_th repeat
+    in_dir: the directory of the saved models
+    model_name
+    X_test
+    y_test
+    load_model_func: the function used to load and recreate the model, i.e., load_model() or, in a worker process
+        (where the cache of load_model() can't be shared), the uncached load_model.__wrapped__()
+    nums_average: the number of testing times
+    is_npy: boolean (default False)
+        If True, convert the model parameters to the '.npy' format first (if it doesn't exist or is outdated) and
+        memory-map them (see main()).
+    unit
+    is_float32: boolean (default False)
+        If True, use float32 (see build_model()).
+    is_fused: boolean (default False)
+        If True, use the fused kernels if possible (see build_model()).
+
+    Returns
+    -------
+        (AUC, test time, model space), or None if it fails.
+    """
+    lg.info(f'***{i}_th repeat')
+    try:
+        # 1. load the model and project parameters from file
+        model_params_file = pth.join(in_dir, f'repeat_{i}.model.model_params')
+        project_params_file = pth.join(in_dir, f'repeat_{i}.model.project_params')
+        for params_file in [model_params_file, project_params_file]:
+            if is_npy and is_npy_outdated(params_file):
+                dat2npy(params_file)
+        mtime = max(pth.getmtime(model_params_file), pth.getmtime(project_params_file))
+        model, project, params = load_model_func(model_params_file, project_params_file, model_name, mtime=mtime,
+                                                  is_float32=is_float32, is_fused=is_fused, is_npy=is_npy)
+        model_space = get_model_space(model_params_file, project_params_file, unit=unit)
+
+        # 2. evaluate the model on the test set
+        auc, test_time = evaluate_model(model, project, params, X_test, y_test, nums=nums_average)
+        # lg.info(f'auc: {auc}, test_time: {test_time}')
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+    return auc, test_time, model_space
+
+
 def main(dataset_name="CTU1", model_name="OCSVM(rbf)", feat_set='iat_size', is_gs=True,
-         nums_average=20, start_time=None):
+         nums_average=3, is_npy=False, n_jobs=1, is_float32=False, is_fused=False,
+         start_time=None):
     """ main function
 
     Parameters
@@ -286,7 +654,21 @@ def main(dataset_name="CTU1", model_name="OCSVM(rbf)", feat_set='iat_size', is_g
     model_name:
     feat_set:
     is_gs:
-    nums_average: the number of testing time (20) for each repeat.
+    nums_average: the number of testing times (default 3, at least 1) for each repeat.
+        main() already averages the testing time over n_repeats (5) models, so a few testing times per
+        repeat are enough to get a stable testing time.
+    is_npy: boolean (default False)
+        If True, convert the model parameters and the test set to the '.npy' format first (only needed once, or again
+        when a '.dat' file is newer than its '.npy' version), so they are memory-mapped instead of being unpickled.
+    n_jobs: the number of processes used to evaluate the repeats in parallel (default 1).
+        A negative value is interpreted as in joblib, e.g., -1 means all the CPUs. 0 is not allowed.
+        Note that the repeats then compete for the CPUs, which inflates the measured testing time.
+    is_float32: boolean (default False)
+        If True, project X_test and compute the OCSVM (rbf) kernel matrix in float32, which is faster but changes
+        the AUC slightly (see build_model()).
+    is_fused: boolean (default False)
+        If True, project X_test and compute the scores in one fused kernel (KJL/Nystrom with OCSVM(rbf), GMM(full) or
+        GMM(diag)), which is faster but changes the AUC slightly (see build_model()).
     start_time
 
     Returns
@@ -296,6 +678,10 @@ def main(dataset_name="CTU1", model_name="OCSVM(rbf)", feat_set='iat_size', is_g
 
     ##############################################################################################################
     # 1. Initialization parameters
+    if nums_average < 1:
+        raise ValueError(f'nums_average must be at least 1, but got {nums_average}')
+    if n_jobs == 0:
+        raise ValueError(f'n_jobs must be a positive or negative integer (e.g., -1 for all the CPUs), but got {n_jobs}')
     # in_dir = 'speedup/out/kjl_serial_ind_32_threads-cProfile_perf_counter'
     in_dir = 'speedup/data/models'
     out_dir = 'speedup/out/models_res'
@@ -333,31 +719,33 @@ def main(dataset_name="CTU1", model_name="OCSVM(rbf)", feat_set='iat_size', is_g
 
     ##############################################################################################################
     # 2. Recreate a new model from the saved parameters and evaluate it on the test set.
-    for i in range(n_repeats):
-        lg.info(f'***{i}_th repeat')
-        try:
-            # 2.1 load the model and project parameters from file
-            model_params_file = pth.join(in_dir, f'repeat_{i}.model.model_params')
-            model_params = load_data(model_params_file)
-            model_params['model_name'] = model_name
-            project_params_file = pth.join(in_dir, f'repeat_{i}.model.project_params')
-            project_params = load_data(project_params_file)
-            model_spaces.append(get_model_space(model_params_file, project_params_file, unit=unit))
-
-            # 2.2 load the test set from file
-            test_set_file = pth.join(in_dir, f'Test_set-repeat_0.dat')
-            X_test, y_test = load_data(test_set_file)
-            X_test_shape = f'{X_test.shape}'
-            test_spaces.append(get_test_set_space(test_set_file, unit=unit))
-
-            # 2.3 evaluate the model on the test set
-            auc, test_time = evaluate_model(model_params, project_params, X_test, y_test, nums=nums_average)
-            # lg.info(f'auc: {auc}, test_time: {test_time}')
-            aucs.append(auc)
-            test_times.append(test_time)
-        except Exception as e:
-            traceback.print_exc()
+    # 2.1 load the test set from file (all the repeats use the same test set, so only load it once)
+    test_set_file = pth.join(in_dir, f'Test_set-repeat_0.dat')
+    if is_npy and is_npy_outdated(test_set_file):
+        dat2npy(test_set_file)
+    X_test, y_test = load_params(test_set_file, is_npy=is_npy)
+    X_test = np.ascontiguousarray(X_test, dtype=np.float64)
+    X_test_shape = f'{X_test.shape}'
+    test_space = get_test_set_space(test_set_file, unit=unit)
+
+    # 2.2 evaluate the repeats (in parallel if n_jobs > 1). They only share the (read-only) test set, which joblib
+    # memory-maps into the worker processes. Use copy-on-write (mmap_mode='c', the same as in load_params()) as the
+    # numba kernels only accept writeable arrays.
+    n_jobs = min(effective_n_jobs(n_jobs), n_repeats)
+    load_model_func = load_model if n_jobs == 1 else load_model.__wrapped__
+    results = Parallel(n_jobs=n_jobs, backend='loky', max_nbytes='1M', mmap_mode='c')(
+        delayed(_one_repeat)(i, in_dir, model_name, X_test, y_test, load_model_func, nums_average, is_npy, unit,
+                             is_float32, is_fused)
+        for i in range(n_repeats))
+    for result in results:
+        if result is None:
             lg.error(f"Error: {dataset_name}, {model_name}")
+            continue
+        auc, test_time, model_space = result
+        aucs.append(auc)
+        test_times.append(test_time)
+        model_spaces.append(model_space)
+        test_spaces.append(test_space)
 
     lg.debug(f'model_spaces: {np.mean(model_spaces):.2f}+/-{np.std(model_spaces):.2f} ({unit}), '
              f'tot: {sum(model_spaces)} ({unit}), {model_spaces}')
@@ -390,6 +778,16 @@ def parse_cmd_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--dataset", help="dataset", default="MAWI1_2020")
     parser.add_argument("-m", "--model", help="model", default="OCSVM(rbf)")
+    parser.add_argument("-n", "--nums-average", help="the number of testing times for each repeat", type=int,
+                        default=3)
+    parser.add_argument("--npy", help="convert the models and the test set to '.npy' files and memory-map them",
+                        action="store_true")
+    parser.add_argument("-j", "--n_jobs", help="the number of processes used to evaluate the repeats", type=int,
+                        default=1)
+    parser.add_argument("--float32", help="project the test set and compute the OCSVM (rbf) kernel matrix in float32 "
+                                          "(faster, but the AUC changes slightly)", action="store_true")
+    parser.add_argument("--fused", help="project the test set and compute the scores in one fused kernel (faster, but "
+                                        "the AUC changes slightly)", action="store_true")
     parser.add_argument("-t", "--time", help="start time of the application",
                         default=time.strftime(TIME_FORMAT, time.localtime()))
     args = parser.parse_args()
@@ -400,4 +798,6 @@ def parse_cmd_args():
 if __name__ == '__main__':
     args = parse_cmd_args()
     print(args)
-    main(dataset_name=args.dataset, model_name=args.model, start_time=args.time)
+    main(dataset_name=args.dataset, model_name=args.model, nums_average=args.nums_average, is_npy=args.npy,
+         n_jobs=args.n_jobs, is_float32=args.float32,
+         is_fused=args.fused, start_time=args.time)
@@ -0,0 +1,247 @@
+"""Fused numba kernels used to speed up the testing phase: each of them projects X (KJL or Nystrom) and computes the
+    scores of the model in one pass.
+    Required: numba (https://numba.pydata.org/)
+
+    The kjl_*_score() kernels are compiled eagerly (i.e., with explicit signatures) when this module is imported, so
+    the compilation time is not included in the measured testing time. With cache=True, the compiled kernels are
+    stored on the disk, so only the first import compiles them.
+    The projection can also be done in float32, i.e., X, Xrow, sigma and P are all float32, while the model part is
+    always computed in float64.
+"""
+# Authors: kun.bj@outlook.com
+#
+# License: XXX
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+# the number of rows (datapoints) processed by one (parallel) iteration of the kernels below
+_BLOCK_SIZE = 64
+
+
+@njit(fastmath=True, cache=True)
+def _project_row(x, XrowT, sigma, P, k_row, x_proj):
+    """ Project one datapoint x onto a lower space: x_proj = K(x, Xrow) @ P, where K is the Gaussian kernel used in
+    getGaussianGram() (i.e., K(x, y) = exp(-||x - y||^2 / sigma^2)).
+
+    Parameters
+    ----------
+    x: array with shape (n_feats, )
+    XrowT: array with shape (n_feats, n_rows)
+        the transposed Xrow
+    sigma: float
+    P: array with shape (n_rows, d)
+        projection matrix, i.e., U (KJL) or eigvec_lambda (Nystrom)
+    k_row: array with shape (n_rows, )
+        buffer for K(x, Xrow)
+    x_proj: array with shape (d, )
+        buffer for the projected x
+
+    Returns
+    -------
+
+    """
+    D, q = XrowT.shape
+    m = P.shape[1]
+    for j in range(q):
+        k_row[j] = 0.0
+    for k in range(D):
+        v = x[k]
+        for j in range(q):
+            diff = v - XrowT[k, j]
+            k_row[j] += diff * diff
+    for j in range(q):
+        k_row[j] = math.exp(-k_row[j] / sigma ** 2)
+
+    for t in range(m):
+        x_proj[t] = 0.0
+    for j in range(q):
+        for t in range(m):
+            x_proj[t] += k_row[j] * P[j, t]
+
+
+@njit(['f8[:](f8[:, :], f8[:, :], f8, f8[:, :], f8[:, :], f8[:], f8, f8)',
+       'f8[:](f4[:, :], f4[:, :], f4, f4[:, :], f8[:, :], f8[:], f8, f8)'], parallel=True, fastmath=True, cache=True)
+def kjl_ocsvm_score(X, Xrow, sigma, P, SV, dual_coef, gamma, intercept):
+    """ Project X (KJL or Nystrom) and compute the OCSVM (rbf) decision values in one pass, so the projected X is
+    never stored in memory.
+
+    Parameters
+    ----------
+    X: array with shape (n_samples, n_feats)
+    Xrow: array with shape (n_rows, n_feats)
+    sigma: float
+    P: array with shape (n_rows, d)
+        U (KJL) or eigvec_lambda (Nystrom)
+    SV: array with shape (n_SVs, d)
+    dual_coef: array with shape (n_SVs, )
+    gamma: float
+    intercept: float
+
+    Returns
+    -------
+        out: array with shape (n_samples, )
+            Note that it is the same as "OCSVM.decision_function(project.transform(X)) * -1"
+    """
+    n = X.shape[0]
+    q, m = P.shape
+    n_svs = SV.shape[0]
+    XrowT = np.ascontiguousarray(Xrow.T)
+    SVT = np.ascontiguousarray(SV.T)
+    out = np.empty(n)
+    n_blocks = (n + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+    for b in prange(n_blocks):
+        # the buffers are only allocated once per block of rows (instead of once per row)
+        k_row = np.empty(q, dtype=X.dtype)
+        x_proj = np.empty(m)
+        acc = np.empty(n_svs)
+        for i in range(b * _BLOCK_SIZE, min((b + 1) * _BLOCK_SIZE, n)):
+            _project_row(X[i], XrowT, sigma, P, k_row, x_proj)
+
+            for j in range(n_svs):
+                acc[j] = 0.0
+            for k in range(m):
+                v = x_proj[k]
+                for j in range(n_svs):
+                    diff = v - SVT[k, j]
+                    acc[j] += diff * diff
+            s = 0.0
+            for j in range(n_svs):
+                s += dual_coef[j] * math.exp(-gamma * acc[j])
+            out[i] = s + intercept
+
+    return out
+
+
+@njit(['f8[:](f8[:, :], f8[:, :], f8, f8[:, :], f8[:], f8[:, :], f8[:, :, :])',
+       'f8[:](f4[:, :], f4[:, :], f4, f4[:, :], f8[:], f8[:, :], f8[:, :, :])'], parallel=True, fastmath=True,
+      cache=True)
+def kjl_gmm_full_score(X, Xrow, sigma, P, weights, means, precisions_cholesky):
+    """ Project X (KJL or Nystrom) and compute the log-likelihood of a GMM ('full' covariance) in one pass.
+
+    Parameters
+    ----------
+    X: array with shape (n_samples, n_feats)
+    Xrow: array with shape (n_rows, n_feats)
+    sigma: float
+    P: array with shape (n_rows, d)
+        U (KJL) or eigvec_lambda (Nystrom)
+    weights: array with shape (n_components, )
+    means: array with shape (n_components, d)
+    precisions_cholesky: array with shape (n_components, d, d)
+
+    Returns
+    -------
+        out: array with shape (n_samples, )
+            Note that it is the same as "GMM.score_samples(project.transform(X))"
+    """
+    n = X.shape[0]
+    q, m = P.shape
+    n_components = weights.shape[0]
+    XrowT = np.ascontiguousarray(Xrow.T)
+    # constant part of each component: log(weight) - 0.5 * d * log(2*pi) + log(det(precisions_cholesky))
+    # and the projected means (means @ precisions_cholesky)
+    const = np.empty(n_components)
+    mu_prec = np.empty((n_components, m))
+    for c in range(n_components):
+        log_det = 0.0
+        for k in range(m):
+            log_det += math.log(precisions_cholesky[c, k, k])
+        const[c] = math.log(weights[c]) - 0.5 * m * math.log(2 * math.pi) + log_det
+        for t in range(m):
+            s = 0.0
+            for k in range(m):
+                s += means[c, k] * precisions_cholesky[c, k, t]
+            mu_prec[c, t] = s
+
+    out = np.empty(n)
+    n_blocks = (n + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+    for b in prange(n_blocks):
+        # the buffers are only allocated once per block of rows (instead of once per row)
+        k_row = np.empty(q, dtype=X.dtype)
+        x_proj = np.empty(m)
+        log_prob = np.empty(n_components)
+        for i in range(b * _BLOCK_SIZE, min((b + 1) * _BLOCK_SIZE, n)):
+            _project_row(X[i], XrowT, sigma, P, k_row, x_proj)
+
+            max_log_prob = -np.inf
+            for c in range(n_components):
+                sq = 0.0
+                for t in range(m):
+                    y = -mu_prec[c, t]
+                    for k in range(m):
+                        y += x_proj[k] * precisions_cholesky[c, k, t]
+                    sq += y * y
+                log_prob[c] = const[c] - 0.5 * sq
+                if log_prob[c] > max_log_prob:
+                    max_log_prob = log_prob[c]
+            # logsumexp
+            s = 0.0
+            for c in range(n_components):
+                s += math.exp(log_prob[c] - max_log_prob)
+            out[i] = max_log_prob + math.log(s)
+
+    return out
+
+
+@njit(['f8[:](f8[:, :], f8[:, :], f8, f8[:, :], f8[:], f8[:, :], f8[:, :])',
+       'f8[:](f4[:, :], f4[:, :], f4, f4[:, :], f8[:], f8[:, :], f8[:, :])'], parallel=True, fastmath=True,
+      cache=True)
+def kjl_gmm_diag_score(X, Xrow, sigma, P, weights, means, precisions_cholesky):
+    """ Project X (KJL or Nystrom) and compute the log-likelihood of a GMM ('diag' covariance) in one pass.
+
+    Parameters
+    ----------
+    X: array with shape (n_samples, n_feats)
+    Xrow: array with shape (n_rows, n_feats)
+    sigma: float
+    P: array with shape (n_rows, d)
+        U (KJL) or eigvec_lambda (Nystrom)
+    weights: array with shape (n_components, )
+    means: array with shape (n_components, d)
+    precisions_cholesky: array with shape (n_components, d)
+
+    Returns
+    -------
+        out: array with shape (n_samples, )
+            Note that it is the same as "GMM.score_samples(project.transform(X))"
+    """
+    n = X.shape[0]
+    q, m = P.shape
+    n_components = weights.shape[0]
+    XrowT = np.ascontiguousarray(Xrow.T)
+    const = np.empty(n_components)
+    for c in range(n_components):
+        log_det = 0.0
+        for k in range(m):
+            log_det += math.log(precisions_cholesky[c, k])
+        const[c] = math.log(weights[c]) - 0.5 * m * math.log(2 * math.pi) + log_det
+
+    out = np.empty(n)
+    n_blocks = (n + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+    for b in prange(n_blocks):
+        # the buffers are only allocated once per block of rows (instead of once per row)
+        k_row = np.empty(q, dtype=X.dtype)
+        x_proj = np.empty(m)
+        log_prob = np.empty(n_components)
+        for i in range(b * _BLOCK_SIZE, min((b + 1) * _BLOCK_SIZE, n)):
+            _project_row(X[i], XrowT, sigma, P, k_row, x_proj)
+
+            max_log_prob = -np.inf
+            for c in range(n_components):
+                sq = 0.0
+                for k in range(m):
+                    y = (x_proj[k] - means[c, k]) * precisions_cholesky[c, k]
+                    sq += y * y
+                log_prob[c] = const[c] - 0.5 * sq
+                if log_prob[c] > max_log_prob:
+                    max_log_prob = log_prob[c]
+            # logsumexp
+            s = 0.0
+            for c in range(n_components):
+                s += math.exp(log_prob[c] - max_log_prob)
+            out[i] = max_log_prob + math.log(s)
+
+    return out
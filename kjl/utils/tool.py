@@ -9,11 +9,14 @@
 import inspect
 import os
 import pickle
+import shutil
 import subprocess
+import tempfile
 import time
 from datetime import datetime
 from functools import wraps
 
+import numpy as np
 import pandas as pd
 
 
@@ -61,6 +64,70 @@ def load_data(in_file):
     return data
 
 
+def dump_npy(data, out_dir):
+    """Save a dict to a directory: each numpy array is saved to its own '.npy' file (so it can be loaded by
+    memory-mapping later) and the remaining (small) values are pickled to 'meta.dat'.
+    All the files are written to a temporary directory first, which is then renamed to out_dir, so out_dir never
+    contains a partially written (or stale) result.
+
+    Parameters
+    ----------
+    data: dict
+
+    out_dir: str
+        out directory
+
+    Returns
+    -------
+
+    """
+    out_dir = os.path.normpath(out_dir)
+    parent_dir = os.path.dirname(out_dir)
+    if not os.path.exists(parent_dir) and len(parent_dir) > 0:
+        os.makedirs(parent_dir)
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(out_dir) + '.tmp', dir=parent_dir if parent_dir else '.')
+    try:
+        meta = {}
+        for key, value in data.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(tmp_dir, f'{key}.npy'), value)
+            else:
+                meta[key] = value
+        dump_data(meta, os.path.join(tmp_dir, 'meta.dat'))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+
+def load_npy(in_dir, mmap_mode='r'):
+    """Load a dict saved by dump_npy()
+
+    Parameters
+    ----------
+    in_dir: str
+        input directory
+    mmap_mode: str (default is 'r')
+        memory-map the '.npy' files (see numpy.load()), so the arrays are read from the disk (or the page cache)
+        only when they are used. If None, read the arrays into the memory.
+
+    Returns
+    -------
+    data: dict
+        loaded data
+    """
+    data = load_data(os.path.join(in_dir, 'meta.dat'))
+    for file_name in os.listdir(in_dir):
+        if file_name.endswith('.npy'):
+            data[file_name[:-len('.npy')]] = np.load(os.path.join(in_dir, file_name), mmap_mode=mmap_mode)
+
+    return data
+
+
 def data_info(data=None, name='data'):
     """Print data basic information
 